@@ -21,9 +21,16 @@ Requirements:
 ===============================================================================
 '''
 
+import json
 import logging
 import os
-from shutil import rmtree
+import re
+import signal
+from itertools import count
+from operator import itemgetter
+from shutil import rmtree, which
+from tempfile import mkdtemp
+from time import sleep
 
 logger = logging.getLogger('2aac')
 console = logging.StreamHandler()
@@ -41,9 +48,14 @@ try:
     import mutagen
     import argparse
 
-    from subprocess import call, Popen, PIPE
-    from multiprocessing import Pool
-    from scandir import walk
+    from mutagen.easyid3 import EasyID3
+    from mutagen.easymp4 import EasyMP4Tags
+
+    from concurrent.futures import ThreadPoolExecutor
+    from subprocess import call, run, Popen, DEVNULL, PIPE, TimeoutExpired
+    from multiprocessing import Pool, cpu_count
+    from multiprocessing.util import Finalize
+    from scandir import scandir
 
 except ImportError as e:
     exit('Error: Unable to import requisite modules: %s' % e)
@@ -62,13 +74,53 @@ def is_progam_valid(program):
 #     if not is_progam_valid(program):
 #         exit('Error: Unable to execute/find "%s" from your PATH.' % program)
 
-# afconvert_help_formats = Popen(
-#     ['afconvert', '-hf'], stderr=PIPE).communicate()[1]
-#
-# data_formats = [
-#     format for format in ['aac', 'aace', 'aacf', 'aach', 'aacl', 'aacp']
-#     if format in afconvert_help_formats
-# ]
+codec_cache_file = os.path.expanduser('~/.cache/xyz2aac/codecs.json')
+
+# Pick out the AAC flavours (aac, aace, aacf, aach, aacl, aacp) in a single pass over the help text:
+afconvert_codec_pattern = re.compile(r'\b(aac[efhlp]?)\b')
+
+
+def get_afconvert_codecs():
+    # Probing afconvert costs a process spawn on every run, so remember its answer on disk for as
+    # long as the afconvert binary itself hasn't changed:
+    afconvert = which('afconvert')
+    if afconvert is None:
+        return []
+
+    cache_key = '%s:%s' % (afconvert, os.stat(afconvert).st_mtime)
+
+    try:
+        with open(codec_cache_file) as f:
+            return json.load(f)[cache_key]
+    except (IOError, ValueError, KeyError):
+        pass
+
+    # Only stderr carries the format list, let the kernel drop anything else. Bound the wait, too,
+    # rather than hanging startup forever on a misbehaving afconvert:
+    try:
+        afconvert_help_formats = run(
+            [afconvert, '-hf'], stdout=DEVNULL, stderr=PIPE,
+            timeout=5).stderr.decode('utf-8', 'ignore')
+
+    except TimeoutExpired:
+        logger.warning('Timed out asking afconvert for its formats.')
+        return []
+
+    codecs = sorted(
+        set(afconvert_codec_pattern.findall(afconvert_help_formats)))
+
+    try:
+        if not os.path.isdir(os.path.dirname(codec_cache_file)):
+            os.makedirs(os.path.dirname(codec_cache_file))
+        with open(codec_cache_file, 'w') as f:
+            json.dump({cache_key: codecs}, f)
+    except (IOError, OSError) as e:
+        logger.debug('Unable to cache afconvert codecs: %s' % e)
+
+    return codecs
+
+
+data_formats = get_afconvert_codecs()
 
 
 def fix_path(path):
@@ -121,6 +173,13 @@ parser.add_argument(
     default='aac',
     help='codec to use, if available on your platform [aac]')
 
+parser.add_argument(
+    '-j',
+    '--jobs',
+    type=int,
+    default=cpu_count(),
+    help='number of files to convert at once [# of CPUs]')
+
 parser.add_argument(
     '--debug', action="store_true", default=False, help='enable debug logging')
 
@@ -135,6 +194,19 @@ bitrate = args.bitrate * 1000
 quality = str(int(args.quality / 100.0 * 127))
 location = fix_path(args.location)
 codec = args.codec
+lossless = args.lossless
+jobs = args.jobs
+
+if jobs < 1:
+    exit('Cannot convert with fewer than 1 job: %s' % jobs)
+
+# The encoder settings are fixed for the whole run, so build afconvert's arguments just once:
+afconvert_alac_args = ('-f', 'm4af', '-d', 'alac', '--soundcheck-generate')
+afconvert_wav_args = ('-f', 'm4af', '-d', codec, '-b', str(bitrate),
+                      '--src-complexity', 'bats', '-u', 'vbrq', quality,
+                      '--soundcheck-generate')
+afconvert_audio_args = ('-f', 'm4af', '-d', codec, '-b', str(bitrate),
+                        '--soundcheck-generate')
 
 # Make sure we've got good paths:
 if os.path.isdir(location):
@@ -143,7 +215,7 @@ if os.path.isdir(location):
 else:
     exit('Requested location does not exist: %s' % location)
 
-if args.lossless:
+if lossless:
     logger.debug(
         'We will be transcoding into Apple Lossless, matching the quality and sample rate.'
     )
@@ -158,156 +230,318 @@ else:
 
 # First create our output directory:
 output_location = os.path.join(location, 'converted_audio')
-tmp_location = '/tmp/intermediate_audio/'
 
 logger.debug('Will place converted files into: "%s".' % output_location)
 
-for loc in (output_location, tmp_location):
-    if not os.path.exists(loc):
-        os.mkdir(loc)
-        logger.debug('Created "%s".' % loc)
+if not os.path.exists(output_location):
+    os.mkdir(output_location)
+    logger.debug('Created "%s".' % output_location)
 
+# Only FLAC files need a temporary directory (for their FIFOs), it's created once we know of one:
+tmp_location = None
 
-def get_audio_files(location):
-    for path, dirs, files in walk(location):
-        for f in files:
-            if (f.endswith('.m4a') or f.endswith('.mp3')
-                    or f.endswith('.flac')) and not f.startswith('.'):
-                print('Got audio file:', f)
-                yield os.path.join(path, f)
+# The source formats afconvert (and flac, for FLAC files) are handed:
+audio_extensions = frozenset(['.m4a', '.mp3', '.flac'])
 
 
-def convert_flac_to_wav(flac_file, wav_file):
-    logger.debug('Converting FLAC file to intermediate WAV file: "%s".' %
+def get_audio_files(location):
+    # Walk with scandir directly, as its entries already know whether they're files or directories
+    # from the directory listing, without an extra stat() per entry. Yields each file's path along
+    # with its size, so that the files can be sorted without stat()ing them all over again:
+    try:
+        entries = scandir(location)
+    except OSError as e:
+        logger.debug('Skipping unreadable directory: "%s" (%s)' % (location, e))
+        return
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            for audio_file in get_audio_files(entry.path):
+                yield audio_file
+
+        elif os.path.splitext(entry.name)[1].lower() in audio_extensions and \
+                not entry.name.startswith('.') and entry.is_file():
+            try:
+                size = entry.stat().st_size
+
+            # A file deleted mid-walk leaves nothing to convert:
+            except OSError as e:
+                logger.debug('Skipping vanished audio file: "%s" (%s)' % (entry.path, e))
+                continue
+
+            logger.info('Got audio file: %s' % entry.name)
+            yield entry.path, size
+
+
+def convert_flac_to_aac(flac_file, m4a_file):
+    # afconvert wants a named input file, so decode into a FIFO instead of a real intermediate WAV
+    # file; no decoded audio touches the disk and the decode overlaps with the encode. Each worker
+    # converts one file at a time, so naming the FIFO after the worker keeps it unique, even for
+    # same-named files from different folders:
+    fifo = os.path.join(tmp_location, '%d.wav' % os.getpid())
+    os.mkfifo(fifo)
+
+    logger.debug('Streaming FLAC file through intermediate WAV FIFO: "%s".' %
                  os.path.basename(flac_file))
-    call(['flac', '-s', '-f', '-d', flac_file, '-o', wav_file])
 
+    try:
+        flac = Popen(['flac', '-s', '-f', '-d', flac_file, '-o', fifo])
+        afconvert = start_wav_encode(fifo, m4a_file)
+
+        # Opening a FIFO blocks until the other end shows up, so whichever side fails first must
+        # not leave the other one waiting on it forever:
+        while afconvert.poll() is None:
+            if flac.poll():
+                # flac gave up, possibly before ever opening the FIFO. Hand afconvert an empty
+                # stream, which fails (ENXIO) until afconvert has opened its end, so keep trying:
+                try:
+                    os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+            sleep(0.1)
+
+        # Having read the whole stream, afconvert leaves flac done or just exiting; otherwise flac
+        # may still be blocked opening, or writing to, the FIFO:
+        flac_killed = afconvert.returncode != 0 and flac.poll() is None
+        if flac_killed:
+            flac.kill()
+
+        flac.wait()
+
+    finally:
+        os.remove(fifo)
+        logger.debug('Removed intermediate WAV FIFO: "%s".' %
+                     os.path.basename(fifo))
+
+    # A flac which dies partway through just looks like the end of the stream to afconvert, which
+    # then happily writes out a truncated file, so flac's own failures have to be checked for too:
+    if flac.returncode != 0 and not flac_killed:
+        logger.error('flac failed to decode: "%s" (exit status %s)' %
+                     (os.path.basename(flac_file), flac.returncode))
+        return False
+
+    if afconvert.returncode != 0:
+        logger.error('afconvert failed to encode: "%s" (exit status %s)' %
+                     (os.path.basename(flac_file), afconvert.returncode))
+        return False
+
+    return True
+
+
+def start_wav_to_alac(wav_file, m4a_file):
+    # TODO: Fix multi-channel audio issues, enable proper conversion:
+    # For 5.1 channel FLAC, cannot use soundcheck, must specify chanel layout:
+    # call(['afconvert', '-f', 'm4af', '-d', 'alac', '-l',  'MPEG_5_1_A', wav_file, m4a_file])
+
+    logger.debug('Converting "%s" to Apple-lossless M4A.' %
+                 os.path.basename(wav_file))
+    return Popen(['afconvert', *afconvert_alac_args, wav_file, m4a_file])
+
+
+def start_wav_to_aac(wav_file, m4a_file):
+    logger.debug('Converting "%s" to a "%s"-B/s, "%s"%% quality "%s"-M4A.' %
+                 (os.path.basename(wav_file), bitrate, quality, codec))
+    return Popen(['afconvert', *afconvert_wav_args, wav_file, m4a_file])
 
-def convert_wav_to_aac(wav_file, m4a_file, lossless=args.lossless):
-    wav_file_name = os.path.basename(wav_file)
-    if args.lossless:
-        # TODO: Fix multi-channel audio issues, enable proper conversion:
-        # For 5.1 channel FLAC, cannot use soundcheck, must specify chanel layout:
-        # call(['afconvert', '-f', 'm4af', '-d', 'alac', '-l',  'MPEG_5_1_A', wav_file, m4a_file])
 
-        logger.debug('Converting "%s" to Apple-lossless M4A.' % wav_file_name)
-        call([
-            'afconvert', '-f', 'm4af', '-d', 'alac', '--soundcheck-generate',
-            wav_file, m4a_file
-        ])
-
-    else:
-        logger.debug('Converting "%s" to a "%s"-B/s, "%s"%% quality "%s"-M4A.'
-                     % (wav_file_name, bitrate, quality, codec))
-        call([
-            'afconvert', '-f', 'm4af', '-d', codec, '-b',
-            str(bitrate), '--src-complexity', 'bats', '-u', 'vbrq', quality,
-            '--soundcheck-generate', wav_file, m4a_file
-        ])
+# Lossless or not is fixed for the whole run, so pick the WAV encoder once instead of per file.
+# Both start afconvert on the WAV stream and return its process, without waiting on it:
+start_wav_encode = start_wav_to_alac if lossless else start_wav_to_aac
 
 
 def convert_audio_to_aac(audio_file, m4a_file):
     logger.debug('Converting "%s" to a "%s"-B/s, "%s"%% quality "%s"-M4A.' %
                  (os.path.basename(audio_file), bitrate, quality, codec))
-    call([
-        'afconvert', '-f', 'm4af', '-d', codec, '-b',
-        str(bitrate), '--soundcheck-generate', audio_file, m4a_file
-    ])
+    status = call(['afconvert', *afconvert_audio_args, audio_file, m4a_file])
 
+    if status != 0:
+        logger.error('afconvert failed to encode: "%s" (exit status %s)' %
+                     (os.path.basename(audio_file), status))
+        return False
 
-def transfer_metadata(source_file, target_file):
+    return True
 
-    target_file_name = os.path.basename(target_file)
 
-    # Open the file with "easy tags" to standardize tagging:
-    metadata = mutagen.File(source_file, easy=True)
+# The tags that are carried over to the converted file:
+valid_keys = frozenset([
+    'album', 'albumartist', 'albumartistsort', 'albumsort', 'artist',
+    'artistsort', 'APIC:', 'comment', 'composersort', 'covr', 'copyright',
+    'date', 'description', 'discnumber', 'genre', 'grouping',
+    'musicbrainz_albumartistid', 'musicbrainz_albumid',
+    'musicbrainz_albumstatus', 'musicbrainz_albumtype', 'musicbrainz_artistid',
+    'musicbrainz_trackid', 'pictures', 'title', 'titlesort', 'tracknumber'
+])
 
-    logger.debug('Read metadata from: "%s".' % os.path.basename(source_file))
 
-    valid_keys = [
-        'album', 'albumartist', 'albumartistsort', 'albumsort', 'artist',
-        'artistsort', 'APIC:'
-        'comment', 'composersort', 'covr', 'copyright', 'date', 'description',
-        'discnumber', 'genre', 'grouping', 'musicbrainz_albumartistid',
-        'musicbrainz_albumid', 'musicbrainz_albumstatus',
-        'musicbrainz_albumtype', 'musicbrainz_artistid', 'musicbrainz_trackid',
-        'pictures', 'title', 'titlesort', 'tracknumber'
-    ]
-
-    for key in list(metadata.keys()):
-        if key not in valid_keys:
-            del metadata[key]
-
-    m4a_data = mutagen.File(target_file, easy=True)
-    m4a_data.update(metadata)
-    m4a_data.save()
+def read_easy_tags(audio, keys):
+    # Equivalent to reading `keys` from mutagen.File(..., easy=True), but reuses an already parsed
+    # file by going through mutagen's own "easy" key tables:
+    if audio.tags is None:
+        return {}
+
+    if type(audio) == mutagen.mp3.MP3:
+        getters = EasyID3.Get
+    elif type(audio) == mutagen.mp4.MP4:
+        getters = EasyMP4Tags.Get
+    else:
+        # Vorbis comments (FLAC) are already "easy":
+        return {key: audio.tags[key] for key in keys if key in audio.tags}
+
+    tags = {}
+    for key in keys & getters.keys():
+        try:
+            tags[key] = getters[key](audio.tags, key)
+        except KeyError:
+            pass
 
-    logger.debug('Saved initial metadata for "%s".' % target_file_name)
+    return tags
 
-    # Open the file again with extended metadata for album art:
-    additional_metadata = mutagen.File(source_file, easy=False)
-    m4a_data = mutagen.File(target_file, easy=False)
 
-    if type(additional_metadata) == mutagen.flac.FLAC:
+def read_cover_art(source):
+    # Gather the source's cover art as MP4 covers, or None if it has none:
+    if type(source) == mutagen.flac.FLAC:
         logger.debug('Examining FLAC metadata for cover art...')
-        if hasattr(additional_metadata, 'pictures'):
-            logger.debug(
-                'Converting FLAC cover art for: "%s"' % target_file_name)
-            m4a_data['covr'] = [
+        if source.pictures:
+            return [
                 mutagen.mp4.MP4Cover(pic.data,
                                      mutagen.mp4.MP4Cover.FORMAT_JPEG)
                 if 'jpeg' in pic.mime else mutagen.mp4.MP4Cover(
                     pic.data, mutagen.mp4.MP4Cover.FORMAT_PNG)
-                for pic in additional_metadata.pictures
+                for pic in source.pictures
             ]
 
-    elif type(additional_metadata) == mutagen.mp3.MP3:
+    elif type(source) == mutagen.mp3.MP3:
         logger.debug('Examining MP3/ID3 metadata for cover art...')
-        if 'APIC:' in additional_metadata:
-            logger.debug(
-                'Converting MP3/ID3 cover art for: "%s"' % target_file_name)
-            m4a_data['covr'] = [
+        if 'APIC:' in source:
+            return [
                 mutagen.mp4.MP4Cover(
-                    additional_metadata['APIC:'].data,
+                    source['APIC:'].data,
                     mutagen.mp4.MP4Cover.FORMAT_JPEG
-                    if 'jpeg' in additional_metadata['APIC:'].mime else
+                    if 'jpeg' in source['APIC:'].mime else
                     mutagen.mp4.MP4Cover.FORMAT_PNG)
             ]
 
-    elif type(additional_metadata) == mutagen.mp4.MP4:
+    elif type(source) == mutagen.mp4.MP4:
         logger.debug('Examining MP4 metadata for cover art...')
-        if 'covr' in additional_metadata:
-            logger.debug(
-                'Converting MP4 cover art for: "%s"' % target_file_name)
-            m4a_data['covr'] = additional_metadata['covr']
+        if 'covr' in source:
+            return source['covr']
+
+    return None
+
+
+def transfer_metadata(source_file, target_file):
+
+    target_file_name = os.path.basename(target_file)
+
+    # Parse each file only once; both the "easy" tags and the cover art come from the source:
+    source = mutagen.File(source_file)
+    tags = read_easy_tags(source, valid_keys)
+    cover_art = read_cover_art(source)
+
+    logger.debug('Read metadata from: "%s".' % os.path.basename(source_file))
+
+    # Untagged sources leave nothing to write, so don't parse and rewrite the new file for nothing:
+    if not tags and not cover_art:
+        logger.debug('No metadata to transfer to: "%s"' % target_file_name)
+        return
+
+    m4a_data = mutagen.File(target_file)
+
+    if m4a_data.tags is None:
+        m4a_data.add_tags()
+
+    # Standardize tagging by writing through the "easy" MP4 key table:
+    for key, value in tags.items():
+        if key in EasyMP4Tags.Set:
+            EasyMP4Tags.Set[key](m4a_data.tags, key, value)
+
+    if cover_art:
+        logger.debug('Converting cover art for: "%s"' % target_file_name)
+        m4a_data['covr'] = cover_art
 
     m4a_data.save()
     logger.debug('Finalized metadata for: "%s"' % target_file_name)
 
 
+def init_worker():
+    global metadata_executor
+
+    # Leave Ctrl-C to the parent, which terminates the whole pool. This is a do-nothing handler
+    # rather than SIG_IGN, as an ignored signal would be inherited by afconvert and flac as well:
+    signal.signal(signal.SIGINT, lambda signum, frame: None)
+
+    # Tag this worker's log records with its PID, so interleaved output can be told apart:
+    console.setFormatter(
+        logging.Formatter(
+            '[%(asctime)s] | %(levelname)-8s | %(process)6d | %(funcName)20s() | %(message)s'
+        ))
+
+    # Each worker transfers one file's metadata on a background thread while it encodes the next.
+    # Pool workers skip atexit handlers, but multiprocessing finalizers still run on their way out:
+    metadata_executor = ThreadPoolExecutor(max_workers=1)
+    Finalize(None, metadata_executor.shutdown, exitpriority=10)
+
+
+def finish_audio_file(audio_file, partial_file, m4a_file):
+    try:
+        transfer_metadata(audio_file, partial_file)
+
+    except Exception:
+        # Nobody waits on this thread's result, so make sure failures are at least reported:
+        logger.exception(
+            'Failed to transfer metadata to: "%s"' % os.path.basename(m4a_file))
+
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+
+    else:
+        # Only complete, tagged files ever show up under their real name:
+        os.replace(partial_file, m4a_file)
+        logger.info('Finished file: %s' % m4a_file)
+
+
+# Numbers each worker's partial files, the worker's PID tells them apart from other workers':
+partial_file_ids = count()
+
+
 def process_audio_file(audio_file):
 
     logger.debug('Began processing: "%s"' % os.path.basename(audio_file))
 
-    if audio_file.endswith('.flac'):
-        m4a_file = os.path.join(output_location,
-                                os.path.basename(audio_file[:-5])) + '.m4a'
-        wav_file = os.path.join(tmp_location, os.path.basename(
-            audio_file[:-5])) + '.wav'
-        convert_flac_to_wav(audio_file, wav_file)
-        convert_wav_to_aac(wav_file, m4a_file)
-        os.remove(wav_file)
-        logger.debug('Removed intermediate WAV file: "%s".' %
-                     os.path.basename(wav_file))
+    # Split the extension off properly, so that e.g. "song.FLAC" is still routed as a FLAC file:
+    stem, extension = os.path.splitext(os.path.basename(audio_file))
+    m4a_file = os.path.join(output_location, stem + '.m4a')
 
-    else:
-        m4a_file = os.path.join(output_location,
-                                os.path.basename(audio_file[:-4])) + '.m4a'
-        convert_audio_to_aac(audio_file, m4a_file)
+    # Encode into a hidden file next to the final one, and rename it into place once it's done; the
+    # rename is atomic as both are on the same filesystem. Same-named files from different folders
+    # can be in flight at once (one still being tagged while the next encodes), so the hidden name
+    # is made unique to this worker and file:
+    partial_file = os.path.join(
+        output_location,
+        '.%s.%d-%d.m4a' % (stem, os.getpid(), next(partial_file_ids)))
+
+    try:
+        if extension.lower() == '.flac':
+            converted = convert_flac_to_aac(audio_file, partial_file)
 
-    transfer_metadata(audio_file, m4a_file)
+        else:
+            converted = convert_audio_to_aac(audio_file, partial_file)
 
-    print('Finished file:', m4a_file)
+    # One file which can't be converted mustn't take the rest of the run down with it:
+    except Exception:
+        logger.exception('Failed to convert: "%s"' %
+                         os.path.basename(audio_file))
+        converted = False
+
+    # Whatever a failed conversion left behind is incomplete, so it's neither tagged nor renamed:
+    if not converted:
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+
+        return
+
+    metadata_executor.submit(finish_audio_file, audio_file, partial_file,
+                             m4a_file)
 
 
 # =============================================================================
@@ -316,18 +550,46 @@ def process_audio_file(audio_file):
 
 print('Processing: %s...' % location)
 
+# Start the largest files first so that the long conversions begin early and the short ones
+# backfill idle workers at the end, instead of a single big FLAC finishing long after the rest:
+audio_files = [
+    audio_file for audio_file, size in sorted(
+        get_audio_files(location), key=itemgetter(1), reverse=True)
+]
+
+# Use a private temporary directory, so that concurrent runs can't collide on (or rmtree) each
+# other's FIFOs. It's created before the pool, so that every worker inherits its location:
+if any(f.lower().endswith('.flac') for f in audio_files):
+    tmp_location = mkdtemp(prefix='xyz2aac_')
+    logger.debug('Created temporary directory: "%s".' % tmp_location)
+
+# One worker per core by default: each worker drives a single-threaded afconvert encode (plus flac
+# decoding into it for FLAC files), so more workers than cores would only fight over the same CPUs.
+# --jobs overrides it, say to leave some cores free for other work:
+pool = Pool(jobs, initializer=init_worker)
+
 try:
-    pool = Pool()
-    p = pool.map_async(process_audio_file, get_audio_files(location))
-    p.get(0xFFFF)
+    # Workers pull the next file as soon as they finish, rather than being handed fixed batches up
+    # front, so one long FLAC doesn't leave the rest of the pool idle:
+    for _ in pool.imap_unordered(
+            process_audio_file, audio_files, chunksize=1):
+        pass
 
 except KeyboardInterrupt:
+    pool.terminate()
+    pool.join()
     exit('Aborting.')
 
-# Clean-up:
-rmtree(tmp_location, ignore_errors=True)
-
-logger.debug('Recursively removed temporary directory: "%s".' % tmp_location)
+else:
+    pool.close()
+    pool.join()
+
+finally:
+    # Clean-up:
+    if tmp_location is not None:
+        rmtree(tmp_location, ignore_errors=True)
+        logger.debug('Recursively removed temporary directory: "%s".' %
+                     tmp_location)
 
 print('Done.')
 
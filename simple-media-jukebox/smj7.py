@@ -8,26 +8,37 @@
 # Imports:
 # ==============================================================================
 
+import atexit
 import logging
 import os
 import sqlite3
 import sys
 from argparse import ArgumentParser
-import importlib
+from collections import defaultdict
+from functools import lru_cache
+from itertools import chain, islice
 
 from json import dumps
 from math import log10
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count
 from random import choice as random_choice
 from random import shuffle
 from subprocess import CalledProcessError, check_call
 from time import sleep, time
 
+from mutagen import MutagenError
 from mutagen.easyid3 import EasyID3 as m3
 from mutagen.easymp4 import EasyMP4 as m4
 from mutagen.flac import FLAC as fl
 from mutagen.oggvorbis import OggVorbis as ov
-from scandir import walk
+from scandir import scandir
+
+# orjson is optional, but encodes large JSON dumps several times faster than the json module:
+try:
+    from orjson import OPT_INDENT_2
+    from orjson import dumps as orjson_dumps
+except ImportError:
+    orjson_dumps = None
 
 # =================================================================================================
 # Initialization
@@ -210,11 +221,53 @@ args.database = true_path(args.database)
 # =================================================================================================
 
 
+def chunks(iterable, size):
+    ''' Yield lists of up to size items from iterable, so they can be handed off in batches. '''
+
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+# Bulk writes hand this many rows at a time to SQLite:
+batch_size = 5000
+
+# Connections are opened once per database file and reused for the rest of the run:
+connections = {}
+
+
+def unicode_lower(value):
+    ''' Lowercase a column's value for LIKE, as SQLite's own case folding only covers ASCII. '''
+    return value.lower() if isinstance(value, str) else value
+
+
+def get_connection(db_file=args.database):
+    ''' Return the shared connection to db_file, opening it on first use. '''
+
+    if db_file not in connections:
+        logger.debug('Opening SQLite connection to: "%s"' % db_file)
+        # Transactions are managed explicitly, rather than by the sqlite3 module guessing at them:
+        conn = sqlite3.connect(db_file, isolation_level=None)
+        conn.create_function('unicode_lower', 1, unicode_lower, deterministic=True)
+        # A write-ahead log with relaxed syncing spares writes the rollback journal and all but the
+        # checkpoints' fsyncs, and a 64 MiB page cache keeps a large library's indexes in memory:
+        conn.execute('pragma journal_mode = wal')
+        conn.execute('pragma synchronous = normal')
+        conn.execute('pragma cache_size = -65536')
+        conn.execute('pragma temp_store = memory')
+        # Closing the connection checkpoints the write-ahead log back into the database file:
+        atexit.register(conn.close)
+        connections[db_file] = conn
+
+    return connections[db_file]
+
+
 def do_sql(query, db_file=args.database, column_data=None, multiple=False):
     ''' A simple SQLite wrapper which handles multiple execution options. '''
-    conn = sqlite3.connect(db_file)
-    conn.text_factory = str
-    conn.row_factory = sqlite3.Row
+    conn = get_connection(db_file)
     curs = conn.cursor()
 
     try:
@@ -222,7 +275,11 @@ def do_sql(query, db_file=args.database, column_data=None, multiple=False):
             logger.debug(
                 'Received executemany SQL transaction for "%s": "%s" with variables.'
                 % (db_file, query))
-            curs.executemany(query, column_data)
+            # Bulk writes stream straight from the column_data iterator into a single transaction,
+            # which takes the write lock up front rather than upgrading to it halfway through:
+            curs.execute('begin immediate')
+            for batch in chunks(column_data, batch_size):
+                curs.executemany(query, batch)
 
         elif column_data is not None:
             logger.debug(
@@ -241,6 +298,12 @@ def do_sql(query, db_file=args.database, column_data=None, multiple=False):
             'Ignoring IntegrityError and overwriting previous values.')
         pass
 
+    # Anything else mustn't leave a half-done transaction open on the shared connection:
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+
     response = curs.fetchall()
 
     conn.commit()
@@ -254,23 +317,81 @@ def do_sql(query, db_file=args.database, column_data=None, multiple=False):
 
 def make_db():
     ''' Perform the initial DB creation, update me if metadata columns change. '''
-    sql = 'create table media(title text, artist text, album text, tracknumber int, discnumber int, genre text, path text unique)'
+    sql = 'create table media(title text, artist text, album text, tracknumber int, discnumber int, genre text, path text unique, mtime int)'
     logger.debug('Creating new SQLite table: "%s" for database in: "%s"' %
                  (sql, args.database))
     do_sql(sql)
+    do_sql(unparseable_sql)
+    make_fts()
+
+
+# Files which couldn't be parsed, say macOS's "._" AppleDouble files, are remembered along with their
+# modification time, so that --freshen doesn't re-parse (and re-warn about) them until they change:
+unparseable_sql = 'create table if not exists unparseable(path text primary key, mtime int)'
+
+
+# A trigram FTS5 index over the searchable columns lets SQLite answer searches for terms of three or
+# more characters from the index, with case-insensitive partial-hit semantics, rather than scanning
+# every row of media:
+fts_sql = [
+    "create virtual table media_fts using fts5(title, artist, album, genre, content='media', content_rowid='rowid', tokenize='trigram')",
+    'create trigger media_fts_insert after insert on media begin insert into media_fts(rowid, title, artist, album, genre) values (new.rowid, new.title, new.artist, new.album, new.genre); end',
+    "create trigger media_fts_delete after delete on media begin insert into media_fts(media_fts, rowid, title, artist, album, genre) values ('delete', old.rowid, old.title, old.artist, old.album, old.genre); end",
+    "create trigger media_fts_update after update on media begin insert into media_fts(media_fts, rowid, title, artist, album, genre) values ('delete', old.rowid, old.title, old.artist, old.album, old.genre); insert into media_fts(rowid, title, artist, album, genre) values (new.rowid, new.title, new.artist, new.album, new.genre); end",
+    "insert into media_fts(media_fts) values ('rebuild')"
+]
+
+
+def make_fts(db_file=args.database):
+    ''' Add the full-text search index and its sync triggers, also used to upgrade older databases. '''
+
+    conn = get_connection(db_file)
+
+    try:
+        for sql in fts_sql:
+            conn.execute(sql)
+
+    # Older SQLite builds lack FTS5 or its trigram tokenizer, in which case we just search media:
+    except sqlite3.OperationalError as e:
+        logger.debug('Not creating full-text search index: %s' % e)
+
+    else:
+        logger.debug('Created full-text search index for database in: "%s"' % db_file)
+
+
+def upgrade_db():
+    ''' Bring a database made by an earlier version up to date with make_db(). '''
+
+    # Rows without a modification time are simply rescanned by the next --freshen:
+    if 'mtime' not in [column[1] for column in do_sql('pragma table_info(media)')]:
+        logger.debug('Adding modification times to database in: "%s"' % args.database)
+        do_sql('alter table media add column mtime int')
+
+    do_sql(unparseable_sql)
+
+    # Databases from before the full-text search index existed get one the first time around:
+    if not has_fts():
+        make_fts()
+
+
+def has_fts(db_file=args.database):
+    ''' Check whether the database has the full-text search index. '''
+    return bool(
+        do_sql("select name from sqlite_master where type = 'table' and name = 'media_fts'",
+               db_file))
 
 
 # -------------------------------------------------------------------------------------------------
 
 
 def play(media_entries):
-    ''' Play given media_entries as a list of dicts as you'd get from searching. '''
+    ''' Play given media_entries as a list of tuples as you'd get from searching. '''
 
-    for media in media_entries:
-        print('\n--> Playing "' + media['title'] + '" off of "' + media['album'] + '" by "' + media['artist'] + '" -->\n')
+    for title, artist, album, path in media_entries:
+        print('\n--> Playing "' + title + '" off of "' + album + '" by "' + artist + '" -->\n')
 
         try:
-            check_call(['mplayer', media['path']])
+            check_call(['mplayer', path])
 
         except (KeyboardInterrupt, CalledProcessError):
             # This sleep helps with mplayer printing exiting stuff to stderr after we've printed our prompt:
@@ -281,49 +402,105 @@ def play(media_entries):
 # -------------------------------------------------------------------------------------------------
 
 
+# The Mutagen parser for each kind of media file we know how to index:
+media_parsers = {'.m4a': m4, '.mp3': m3, '.ogg': ov, '.oga': ov, '.flac': fl}
+
+# Potential media files are only caught via their filename extension, we could validate this in the future:
+media_extensions = tuple(media_parsers)
+
+
+def get_media_entries(path):
+    ''' Walk the tree with scandir directly and recurse ourselves, as each DirEntry already knows if
+        it's a directory from the directory listing itself, and keeps its stat() once asked for. '''
+
+    try:
+        entries = scandir(path)
+    except OSError as e:
+        logger.debug('Skipping unreadable directory: "%s" (%s)' % (path, e))
+        return
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            for media_entry in get_media_entries(entry.path):
+                yield media_entry
+
+        elif entry.name.lower().endswith(media_extensions):
+            yield entry
+
+
 def get_media_files(path):
-    ''' Using scandir's optimized walking algorithm, we can discard GNU's `find`. Only catches
-        potential files via filename extension, but we could validate this in the future. '''
+    ''' Yield the paths and modification times of all potential media files under path. '''
 
-    for root, dirs, files in walk(path):
-        for filename in files:
-            if filename.endswith(('.m4a', '.mp3', '.ogg', '.oga', '.flac')):
-                logger.debug('Found a potential media file: "%s"' %
-                             os.path.join(root, filename))
-                yield os.path.join(root, filename)
+    for entry in get_media_entries(path):
+        try:
+            mtime = entry.stat().st_mtime_ns
+
+        # A dangling symlink, or a file deleted mid-walk, leaves nothing to index:
+        except OSError as e:
+            logger.debug('Skipping unreadable media file: "%s" (%s)' % (entry.path, e))
+            continue
+
+        logger.debug('Found a potential media file: "%s"' % entry.path)
+        yield entry.path, mtime
 
 
 def get_new_media_files(path):
-    ''' Using scandir's optimized walking algorithm, we can discard GNU's `find`. Only catches
-        potential files via filename extension, but we could validate this in the future. '''
+    ''' Return the paths and modification times of potential media files under path which are new or
+        changed since they were last scanned. '''
 
-    db_time = os.stat(args.database)[8]
+    conn = get_connection()
+    curs = conn.cursor()
 
-    for root, dirs, files in walk(path):
-        for filename in files:
-            absolute_filename = os.path.join(root, filename)
-            if filename.endswith(
-                ('.m4a', '.mp3', '.ogg', '.oga',
-                 '.flac')) and os.stat(absolute_filename)[8] > db_time:
-                logger.debug('Found a potential newer media file: "%s"' %
-                             absolute_filename)
-                yield absolute_filename
+    # Stream what's on disk into a temporary table, and let SQLite diff it against the media table,
+    # rather than pulling every path and modification time into Python:
+    curs.execute('create temp table if not exists walked(path text primary key, mtime int)')
+    curs.execute('begin')
+    curs.execute('delete from walked')
+    curs.executemany('insert into walked values (?, ?)', get_media_files(path))
+    # Forget about unparseable files which are no longer there:
+    curs.execute('delete from unparseable where path not in (select path from walked)')
+    curs.execute('commit')
+
+    # Not just newer: a file restored from a backup can well be older than what was scanned. Files
+    # which are known to be unparseable are skipped until they change, too. These are fetched in
+    # full, as the serial indexer will be writing to media while they're parsed:
+    new_media_files = curs.execute(
+        'select walked.path, walked.mtime from walked left join media on media.path = walked.path left join unparseable on unparseable.path = walked.path where media.mtime is not walked.mtime and unparseable.mtime is not walked.mtime'
+    ).fetchall()
+    curs.close()
+
+    for media_file in new_media_files:
+        logger.debug('Found a potential newer media file: "%s"' % media_file[0])
+
+    return new_media_files
 
 
 def get_stale_entries(db_file=args.database):
     ''' Return entries from the database only if they're not present on-disk. '''
 
-    # We aren't going to use do_sql() as we want an iterator, and don't need the Row type:
-    with sqlite3.connect(db_file) as conn:
-        conn.text_factory = str
-        curs = conn.cursor()
+    # Bucket the paths by directory, so each directory is listed once instead of each file stat'd:
+    directories = defaultdict(list)
 
-        for row in curs.execute('select path from media'):
-            if not os.path.exists(row[0]):
-                logger.debug('Got stale entry: "%s"' % row[0])
-                yield row
+    for (path, ) in get_connection(db_file).execute('select path from media'):
+        directories[os.path.dirname(path)].append(path)
 
-        curs.close()
+    # Visit the directories in order, so that neighbouring ones are listed back to back:
+    for directory in sorted(directories):
+        paths = directories[directory]
+
+        try:
+            # Like os.path.exists(), a symlink only counts if its target is still there:
+            present = set(entry.name for entry in scandir(directory)
+                          if not entry.is_symlink() or os.path.exists(entry.path))
+
+        # A directory which is gone (or unreadable) takes all of its entries with it:
+        except OSError:
+            present = set()
+
+        for path in paths:
+            if os.path.basename(path) not in present:
+                logger.debug('Got stale entry: "%s"' % path)
+                yield (path, )
 
 
 def remove_stale_entries(db_file=args.database):
@@ -333,22 +510,20 @@ def remove_stale_entries(db_file=args.database):
               when entries have been deleted from disk.
     '''
 
-    before_count = do_sql('select count(path) from media')[0][0]
+    before_count = do_sql('select count(*) from media')[0][0]
     before = time()
 
-    # We aren't going to use do_sql() as we want an iterator, and don't need the Row type:
-    with sqlite3.connect(db_file) as conn:
-        conn.text_factory = str
-        curs = conn.cursor()
-
-        curs.executemany('delete from media where path = ?',
-                         get_stale_entries())
-
-        conn.commit()
-        curs.close()
+    # All of the deletes go into a single transaction:
+    do_sql('delete from media where path = ?',
+           db_file,
+           column_data=get_stale_entries(db_file),
+           multiple=True)
 
     after = time()
-    after_count = do_sql('select count(path) from media')[0][0]
+    after_count = do_sql('select count(*) from media')[0][0]
+
+    # Earlier searches may include what was just removed:
+    run_search.cache_clear()
 
     print('Pruner: Removed %s stale files from the databse in %s seconds.' % (
         before_count - after_count, round(after - before, 2)))
@@ -357,46 +532,41 @@ def remove_stale_entries(db_file=args.database):
 # -------------------------------------------------------------------------------------------------
 
 
-def parse_media_file(path):
+def parse_media_file(media_file):
     ''' Perform the parsing of media metadata, and clean it up into a more sensible format. '''
 
-    filename = os.path.split(path)[1]
-    filename_split = os.path.splitext(filename)
-    extension = filename_split[1]
-
-    if extension == '.m4a':
-        mutagen_metadata = m4(path)
-
-    elif extension == '.mp3':
-        mutagen_metadata = m3(path)
+    path, mtime = media_file
+    stem, extension = os.path.splitext(os.path.basename(path))
 
-    elif extension in ('.oga', '.ogg'):
-        mutagen_metadata = og(path)
+    try:
+        mutagen_metadata = media_parsers[extension.lower()](path)
 
-    elif extension == '.flac':
-        mutagen_metadata = fl(path)
+    # Don't let one unreadable or mislabelled file take the whole indexing run down with it, and hand
+    # back just its path and modification time, so that it can be remembered as unparseable:
+    except (MutagenError, OSError) as e:
+        logger.warning('Skipping unparseable media file: "%s" (%s)' % (path, e))
+        return media_file
 
     # Remember, the Mutagen tag's value is a list:
-    smj_metadata = {
-        'artist': mutagen_metadata.get('artist', ['unknown artist'])[0],
-        'album': mutagen_metadata.get('album', ['unknown album'])[0],
-        'title': mutagen_metadata.get('title', [filename_split[0]])[0],
-        'genre': mutagen_metadata.get('genre', ['unknown genre'])[0],
-        'path': path
-    }
+    artist = mutagen_metadata.get('artist', ['unknown artist'])[0]
 
     # Prefer the "sort" "album artist", which won't include things like "Someone featuring So-and-So":
-    smj_metadata['artist'] = mutagen_metadata.get('albumartistsort',
-                                                  [smj_metadata['artist']])[0]
+    artist = mutagen_metadata.get('albumartistsort', [artist])[0]
 
     # Catch very odd cases where the 'tracknumber' field is something other than a digit:
+    numbers = []
     for number in ['tracknumber', 'discnumber']:
         try:
-            smj_metadata[number] = int(
-                mutagen_metadata.get(number, ['0/0'])[0].split('/')[0])
+            numbers.append(
+                int(mutagen_metadata.get(number, ['0/0'])[0].partition('/')[0]))
 
         except ValueError:
-            smj_metadata[number] = 0
+            numbers.append(0)
+
+    # A plain tuple in insert_sql's column order is much cheaper to pickle back from the pool than a dict:
+    smj_metadata = (mutagen_metadata.get('title', [stem])[0], artist,
+                    mutagen_metadata.get('album', ['unknown album'])[0], numbers[0], numbers[1],
+                    mutagen_metadata.get('genre', ['unknown genre'])[0], path, mtime)
 
     logger.debug('Parsed: %s' % str(smj_metadata))
 
@@ -405,28 +575,109 @@ def parse_media_file(path):
 
 # -------------------------------------------------------------------------------------------------
 
-# Both serial and parallel indexers use this SQL to shove data into SQLite:
-insert_sql = 'insert into media (title, artist, album, tracknumber, discnumber, genre, path) values (:title, :artist, :album, :tracknumber, :discnumber, :genre, :path)'
+# Both serial and parallel indexers use this SQL to shove data into SQLite. Rescanned files update
+# their existing rows in place, which (unlike "insert or replace") keeps the FTS triggers in step:
+insert_sql_start = 'insert into media (title, artist, album, tracknumber, discnumber, genre, path, mtime) values '
+insert_sql_row = '(?, ?, ?, ?, ?, ?, ?, ?)'
+insert_sql_end = ' on conflict(path) do update set title = excluded.title, artist = excluded.artist, album = excluded.album, tracknumber = excluded.tracknumber, discnumber = excluded.discnumber, genre = excluded.genre, mtime = excluded.mtime'
+
+insert_sql = insert_sql_start + insert_sql_row + insert_sql_end
+
+# ...mostly in its multi-row form, so that each statement SQLite steps through inserts many rows:
+rows_per_insert = 50
+multi_insert_sql = insert_sql_start + ', '.join([insert_sql_row] * rows_per_insert) + insert_sql_end
+
+
+def get_insert_params(rows):
+    ''' Flatten rows into the parameters for multi_insert_sql, leaving any remainder to insert_sql. '''
+
+    for batch in chunks(rows, batch_size):
+        whole = len(batch) - len(batch) % rows_per_insert
+
+        for i in range(0, whole, rows_per_insert):
+            yield multi_insert_sql, tuple(chain.from_iterable(batch[i:i + rows_per_insert]))
+
+        for row in batch[whole:]:
+            yield insert_sql, row
+
+
+def set_aside_unparseable(results, unparseable):
+    ''' Pass parsed media rows through, collecting the (path, mtime) of unparseable files instead. '''
+
+    for result in results:
+        if len(result) == 2:
+            unparseable.append(result)
+        else:
+            yield result
+
+
+def insert_media(results, db_file=args.database):
+    ''' Insert parsed media rows in a single transaction, many rows per statement, remembering the
+        files which couldn't be parsed, and return how many rows were written. '''
+
+    conn = get_connection(db_file)
+    curs = conn.cursor()
+    written = 0
+    unparseable = []
+
+    try:
+        curs.execute('begin immediate')
+        for sql, params in get_insert_params(set_aside_unparseable(results, unparseable)):
+            curs.execute(sql, params)
+            written += curs.rowcount
+
+        curs.executemany('insert or replace into unparseable values (?, ?)', unparseable)
+        # Files which parsed before, but no longer do, mustn't linger in searches under their old tags:
+        curs.executemany('delete from media where path = ?', [(path, ) for path, mtime in unparseable])
+        # Files which have since been fixed up are no longer unparseable:
+        curs.execute('delete from unparseable where exists (select 1 from media where media.path = unparseable.path)')
+
+    # As with do_sql(), we don't care about overwriting values within the database:
+    except sqlite3.IntegrityError:
+        logger.debug(
+            'Ignoring IntegrityError and overwriting previous values.')
+
+    except BaseException:
+        conn.rollback()
+        raise
+
+    conn.commit()
+    curs.close()
+
+    return written
+
+
+# Below this many files, say on most freshens, starting up the worker processes (which re-import
+# everything where they're spawned rather than forked, as on macOS) takes longer than the parsing:
+min_parallel_files = 100
 
 
 def index_media(location=args.location, freshen=args.freshen):
     ''' Link the media file fetcher with the parser, and update the database. '''
 
     if freshen:
-        before_count = do_sql('select count(path) from media')[0][0]
         file_getter = get_new_media_files
     else:
         file_getter = get_media_files
 
     before = time()
 
-    if args.force_serial:
+    try:
+        media_files = file_getter(location)
+
+        # Walk the whole tree up front when parsing in parallel, so the workers aren't left waiting on
+        # the disk, and so both the chunksize and whether to start the pool at all can be decided:
+        if not args.force_serial:
+            media_files = list(media_files)
+
+    except KeyboardInterrupt:
+        exit(1)
+
+    if args.force_serial or len(media_files) < min_parallel_files:
         adverb = 'Serially'
         try:
-            do_sql(
-                insert_sql,
-                column_data=map(parse_media_file, file_getter(location)),
-                multiple=True)
+            # Files which couldn't be parsed come back as just their path and modification time:
+            count = insert_media(map(parse_media_file, media_files))
 
         except KeyboardInterrupt:
             exit(1)
@@ -435,12 +686,12 @@ def index_media(location=args.location, freshen=args.freshen):
         adverb = 'Parallely'
         pool = Pool()
         try:
-            # Set the chunksize for imap_unordered to a low but doable number that is > 1 for slightly better performance:
-            do_sql(
-                insert_sql,
-                column_data=pool.imap_unordered(parse_media_file,
-                                                file_getter(location), 8),
-                multiple=True)
+            # Parsing a file is quick next to a round trip to a worker, so hand out at least 16 at a
+            # time, and split large libraries ~8 chunks per core:
+            chunksize = max(16, len(media_files) // (cpu_count() * 8))
+
+            count = insert_media(
+                pool.imap_unordered(parse_media_file, media_files, chunksize))
 
         except KeyboardInterrupt:
             pool.terminate()
@@ -451,84 +702,161 @@ def index_media(location=args.location, freshen=args.freshen):
             pool.close()
             pool.join()
 
+    # Earlier searches won't include what was just indexed:
+    run_search.cache_clear()
+
     after = time()
 
+    # The inserts already know how many files they wrote, new or updated, so don't count them again:
     if freshen:
-        after_count = do_sql('select count(path) from media')[0][0]
         print('Indexer: %s indexed %s newer files in %s seconds.' % (
-            adverb, after_count - before_count, round(after - before, 2)))
+            adverb, count, round(after - before, 2)))
     else:
         print('Indexer: %s indexed %s files in %s seconds.' % (
-            adverb, do_sql('select count(path) from media')[0][0],
-            round(after - before, 2)))
+            adverb, count, round(after - before, 2)))
 
 
 # -------------------------------------------------------------------------------------------------
 
 
+def get_fts_query(params_by_columns):
+    ''' Express the search as a single FTS5 query, or return None if it can't be. The trigram index
+        folds the case of all of Unicode, so the LIKE fallback in get_search_sql() does too. '''
+
+    groups = []
+
+    for columns, params in params_by_columns:
+        # The trigram index matches any substring of three or more characters, as LIKE '%term%' does,
+        # while shorter terms match nothing, and LIKE's wildcards would be taken literally:
+        if any(len(param) < 3 or '%' in param or '_' in param for param in params):
+            return None
+
+        if params:
+            groups.append('(' + ' OR '.join(
+                '{%s} : "%s"' % (' '.join(columns), param.replace('"', '""'))
+                for param in params) + ')')
+
+    return ' AND '.join(groups)
+
+
 def search_media(input_string):
-    ''' Parse the SMJ7-style syntax, create the requisite SQL, and execute it. '''
+    ''' Search for media with an SMJ7-style query, see run_search(). '''
+
+    # Hand out a fresh list each time, as the playlist commands reorder it in place. Whether there's
+    # a full-text index is part of what's cached, as it changes the SQL (and so, possibly, results):
+    return list(run_search(input_string.strip(), has_fts()))
+
+
+# Repeated searches, say between plays in the interactive loop, are answered from memory:
+@lru_cache(maxsize=128)
+def run_search(input_string, fts):
+    ''' Execute an SMJ7-style search, with its results in artist, album, and track order. '''
+
+    sql, sql_params = get_search_sql(input_string, fts)
+
+    return tuple(
+        do_sql(sql + ' order by artist, album, discnumber, tracknumber', column_data=sql_params))
+
+
+def pick_random_media(input_string):
+    ''' Execute an SMJ7-style search, but have SQLite pick out a single random result. '''
+
+    sql, sql_params = get_search_sql(input_string.strip(), has_fts())
+
+    return do_sql(sql + ' order by random() limit 1', column_data=sql_params)
+
+
+# Searches hand back just what playing and listing media needs, as plain tuples in this order:
+media_columns = 'title, artist, album, path'
+
+# Each SMJ7-style sigil, and the columns its terms search; terms without one search several at once:
+search_categories = [('!', ['genre']), ('@', ['artist']), ('#', ['album']), ('$', ['title']),
+                     ('', ['artist', 'album', 'title'])]
 
-    pre_sql = 'select * from media where '
-    sql = ''
-    post_sql = ' order by artist, album, discnumber, tracknumber'
 
-    # These will store the different columns we'll be searching:
-    genre_params = []
-    artist_params = []
-    album_params = []
-    title_params = []
-    multi_params = []
+def get_search_sql(input_string, fts):
+    ''' Parse the SMJ7-style syntax, and create the requisite SQL (sans ordering) and variables,
+        searching through the full-text index if fts is set. '''
 
-    # Break up the inputted string, get rid of whitespace, and filter it into the above categories:
+    # These will store the terms for each category of columns we'll be searching:
+    params = dict((sigil, []) for sigil, columns in search_categories)
+
+    # Break up the inputted string, get rid of whitespace, and file the terms under their sigils:
     for word in input_string.split(','):
         word = word.strip()
 
-        if word.startswith('!'):
-            genre_params.append(word[1:])
+        if word[:1] in params:
+            params[word[:1]].append(word[1:])
 
-        elif word.startswith('@'):
-            artist_params.append(word[1:])
+        else:
+            params[''].append(word)
 
-        elif word.startswith('#'):
-            album_params.append(word[1:])
+    params_by_columns = [(columns, params[sigil]) for sigil, columns in search_categories]
 
-        elif word.startswith('$'):
-            title_params.append(word[1:])
+    # Where possible, have the full-text index answer the whole search in one lookup:
+    fts_query = fts and get_fts_query(params_by_columns)
 
-        else:
-            multi_params.append(word)
-
-    # These SQL blocks logically OR same-category (same-column) parameters, and group them:
-    genre_sql = '(' + ' or '.join(['genre like ?'] * len(genre_params)) + ')'
-    artist_sql = '(' + ' or '.join(
-        ['artist like ?'] * len(artist_params)) + ')'
-    album_sql = '(' + ' or '.join(['album like ?'] * len(album_params)) + ')'
-    title_sql = '(' + ' or '.join(['title like ?'] * len(title_params)) + ')'
-    multi_sql = '(' + ' or '.join(
-        ['artist like ? or album like ? or title like ?'
-         ] * len(multi_params)) + ')'
-
-    # This logically ANDs together the OR blocks from above:
-    sql = pre_sql + ' and '.join(
-        [x for x in [genre_sql, artist_sql, album_sql, title_sql, multi_sql
-                ] if len(x) > 2]) + post_sql
-
-    # This creates the actual collection of variables for use with SQLite's "?" substitution:
-    sql_params = [
-        '%' + param + '%' for param in genre_params + artist_params +
-        album_params + title_params + multi_params * 3
-    ]
+    if fts_query:
+        sql = 'select ' + media_columns + ' from media where rowid in (select rowid from media_fts where media_fts match ?)'
+        sql_params = [fts_query]
+
+    else:
+        # Logically OR each category's terms across its columns, and AND the categories together,
+        # while collecting each term for each of its columns for SQLite's "?" substitution:
+        blocks = []
+        sql_params = []
+
+        for columns, terms in params_by_columns:
+            likes = []
+
+            for term in terms:
+                # LIKE already folds ASCII, anything else is folded here as the full-text index would:
+                if term.isascii():
+                    likes.extend([column + ' like ?' for column in columns])
+                else:
+                    likes.extend(['unicode_lower(' + column + ') like ?' for column in columns])
+                    term = term.lower()
+
+                sql_params.extend(['%' + term + '%' for column in columns])
+
+            if likes:
+                blocks.append('(' + ' or '.join(likes) + ')')
+
+        sql = 'select ' + media_columns + ' from media where ' + ' and '.join(blocks)
 
     logger.debug('Crafted SQL statement: "%s"' % sql)
     logger.debug('Crafted SQL variables: "%s"' % sql_params)
 
-    return do_sql(sql, column_data=sql_params)
+    return sql, sql_params
 
 
 # -------------------------------------------------------------------------------------------------
 
 
+def play_all(media_entries):
+    ''' Play all media entries, in order. '''
+
+    play(media_entries)
+
+
+def play_random(media_entries):
+    ''' Play a single, random media entry. '''
+
+    play([random_choice(media_entries)])
+
+
+def play_shuffled(media_entries):
+    ''' Play all media entries, in a random order. '''
+
+    # random.shuffle does it in-place:
+    shuffle(media_entries)
+    play(media_entries)
+
+
+# Playlist commands by their first letter, with no command at all meaning all of them:
+playlist_commands = {'': play_all, 'a': play_all, 'r': play_random, 's': play_shuffled}
+
+
 def playlist_handler(input_string, media_entries):
     ''' Handle the commands needed to generate a playlist. '''
 
@@ -540,20 +868,14 @@ def playlist_handler(input_string, media_entries):
             play(media_entries[input_string - 1:])
         else:
             print('Enter value from 1 to %s, try again.' % len(media_entries))
+        return
 
-    elif input_string.startswith('a') or input_string == '':
-        play(media_entries)
-
-    elif input_string.startswith('r'):
-        play([random_choice(media_entries)])
-
-    elif input_string.startswith('s'):
-        # random.shuffle does it in-place:
-        shuffle(media_entries)
-        play(media_entries)
+    command = playlist_commands.get(input_string[:1])
 
+    if command:
+        command(media_entries)
     else:
-        'Not a valid playlist command, try again.'
+        print('Not a valid playlist command, try again.')
 
 
 # -------------------------------------------------------------------------------------------------
@@ -568,21 +890,20 @@ def jsonizer(media_entries, show_paths=args.show_paths):
     else:
         json_indentation_option = args.indent
 
-    hierarchy = {}
+    # Artists and albums spring into being as they're first seen, both encoders take these as dicts:
+    hierarchy = defaultdict(lambda: defaultdict(list))
 
-    for media in media_entries:
+    for title, artist, album, path in media_entries:
         if show_paths:
-            track = {'title': media['title'], 'path': media['path']}
+            track = {'title': title, 'path': path}
         else:
-            track = media['title']
+            track = title
 
-        if media['artist'] in hierarchy:
-            if media['album'] in hierarchy[media['artist']]:
-                hierarchy[media['artist']][media['album']].append(track)
-            else:
-                hierarchy[media['artist']][media['album']] = [track]
-        else:
-            hierarchy[media['artist']] = {media['album']: [track]}
+        hierarchy[artist][album].append(track)
+
+    # orjson only knows how to indent by 2 spaces, other indentations are left to the json module:
+    if orjson_dumps and args.indent in (0, 2):
+        return orjson_dumps(hierarchy, option=OPT_INDENT_2 if args.indent else None).decode()
 
     return dumps(hierarchy, indent=json_indentation_option)
 
@@ -603,8 +924,11 @@ if __name__ == '__main__':
             make_db()
             index_media()
 
-        elif args.freshen:
-            index_media()
+        else:
+            upgrade_db()
+
+            if args.freshen:
+                index_media()
 
         if args.prune:
             remove_stale_entries()
@@ -615,7 +939,7 @@ if __name__ == '__main__':
 
     # If someone wants a full dump of their music collection:
     if args.json and not args.query:
-        print(jsonizer(do_sql('select * from media')))
+        print(jsonizer(do_sql('select ' + media_columns + ' from media')))
         exit()
 
     # For non-interactive searching:
@@ -626,10 +950,14 @@ if __name__ == '__main__':
             query = args.query
             command = 'a'
 
+        # A random pick needs just the one row, so let SQLite choose it instead of fetching them all:
+        if command.strip().startswith('r') and not args.json:
+            play(pick_random_media(query))
+            exit()
+
         results = search_media(query)
 
         if args.json:
-            # sqlite.Row objects are not JSON serializable, `dict` them here:
             print(jsonizer(results))
             # Exit as JSON is not intended for playback:
             exit()
@@ -643,7 +971,7 @@ if __name__ == '__main__':
     # Interactive loop
     # =============================================================================================
 
-    count = do_sql('select count(path) from media')[0][0]
+    count = do_sql('select count(*) from media')[0][0]
 
     print('For help with SMJ7-style syntax, use ./smj7.py --syntax')
     print('Available parameters: !genre, @artist name, #album name, $track name')
@@ -670,29 +998,28 @@ if __name__ == '__main__':
                         [2] Track 2
                 '''
 
-                for i, result in enumerate(results):
+                # Build up the listing and write it out in one go, rather than print()ing every line:
+                lines = []
+                width = int(log10(len(results))) + 1
+
+                for i, (title, new_artist, new_album, path) in enumerate(results):
                     # Pad out the number so all of them line up:
-                    i = '[ ' + str(i + 1).rjust(int(log10(len(results))) +
-                                                1) + ' ]'
-
-                    if artist == result['artist']:
-                        if album == result['album']:
-                            print('    ', i, result['title'])
-
-                        else:
-                            print('\n  ', result['album'])
-                            print('   ' + '-' * len(result['album']))
-                            print('    ', i, result['title'])
-
-                    else:
-                        print('\n', result['artist'])
-                        print('=' * len(result['artist']))
-                        print('\n  ', result['album'])
-                        print('   ' + '-' * len(result['album']))
-                        print('    ', i, result['title'])
-
-                    artist = result['artist']
-                    album = result['album']
+                    i = '[ ' + str(i + 1).rjust(width) + ' ]'
+
+                    if artist != new_artist:
+                        lines.append('\n ' + new_artist + '\n')
+                        lines.append('=' * len(new_artist) + '\n')
+
+                    if artist != new_artist or album != new_album:
+                        lines.append('\n   ' + new_album + '\n')
+                        lines.append('   ' + '-' * len(new_album) + '\n')
+
+                    lines.append('     ' + i + ' ' + title + '\n')
+
+                    artist = new_artist
+                    album = new_album
+
+                sys.stdout.write(''.join(lines))
 
                 print('\nEnter # to play, or one of: (A)ll, (R)andom choice, or (S)huffle all\n')
                 choice = input('[Play command] > ').lower()
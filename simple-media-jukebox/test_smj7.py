@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# coding: utf-8
+# test_smj7.py | Tests for the Simple Media Jukebox's indexer and search
+# Licensed under the MIT license
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+from mutagen.easyid3 import EasyID3
+
+# smj7 parses its arguments as it's imported, so point it at a scratch library and database first:
+scratch = tempfile.mkdtemp(prefix='smj7_test_')
+library = os.path.join(scratch, 'library')
+database = os.path.join(scratch, 'smj7.sqlite')
+os.mkdir(library)
+
+sys.argv = ['smj7.py', '--location', library, '--database', database]
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import smj7  # noqa: E402
+
+
+def make_mp3(path, title):
+    ''' Write a file EasyID3 will read, which is nothing more than an ID3 tag. '''
+
+    tags = EasyID3()
+    tags['title'] = title
+    tags['artist'] = 'Die Ärzte'
+    tags['album'] = 'Jazz ist anders'
+    tags.save(path)
+
+
+def bump_mtime(path):
+    ''' Move a file's modification time on, as a --freshen would see it after an edit. '''
+
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+class LibraryTest(unittest.TestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    def setUp(self):
+        for name in os.listdir(library):
+            os.remove(os.path.join(library, name))
+
+        # Start each test from an empty database, through the same connection smj7 keeps:
+        conn = smj7.get_connection()
+        conn.execute('drop table if exists media')
+        conn.execute('drop table if exists media_fts')
+        conn.execute('drop table if exists unparseable')
+        smj7.make_db()
+
+    def table(self, sql):
+        return sqlite3.connect(database).execute(sql).fetchall()
+
+    def test_broken_file_is_dropped_and_remembered(self):
+        good = os.path.join(library, 'good.mp3')
+        broken = os.path.join(library, 'broken.mp3')
+        make_mp3(good, 'Schunder-Song')
+        make_mp3(broken, 'Ärger im Paradies')
+
+        smj7.index_media(library, freshen=False)
+        self.assertEqual(len(smj7.search_media('paradies')), 1)
+
+        # A file which was parseable, but no longer is:
+        with open(broken, 'wb') as f:
+            f.write(b'not an mp3 at all')
+        bump_mtime(broken)
+
+        with self.assertLogs('smj7', 'WARNING'):
+            smj7.index_media(library, freshen=True)
+
+        self.assertEqual(self.table('select path from unparseable'), [(broken, )])
+        self.assertEqual(self.table('select path from media'), [(good, )])
+        self.assertEqual(smj7.search_media('paradies'), [])
+
+        # Later freshens leave it be, until it changes again:
+        with self.assertNoLogs('smj7', 'WARNING'):
+            smj7.index_media(library, freshen=True)
+            smj7.index_media(library, freshen=True)
+
+        self.assertEqual(self.table('select path from unparseable'), [(broken, )])
+
+    def test_fixed_file_is_indexed_again(self):
+        fixed = os.path.join(library, 'fixed.mp3')
+
+        with open(fixed, 'wb') as f:
+            f.write(b'not an mp3 at all')
+
+        smj7.index_media(library, freshen=False)
+        self.assertEqual(self.table('select path from unparseable'), [(fixed, )])
+
+        make_mp3(fixed, 'Ärger im Paradies')
+        bump_mtime(fixed)
+        smj7.index_media(library, freshen=True)
+
+        self.assertEqual(self.table('select path from unparseable'), [])
+        self.assertEqual(len(smj7.search_media('paradies')), 1)
+
+    def test_case_folding_does_not_depend_on_term_length(self):
+        make_mp3(os.path.join(library, 'song.mp3'), 'Ärger im Paradies')
+        smj7.index_media(library, freshen=False)
+
+        # Long terms are answered by the full-text index, short and wildcard ones by LIKE:
+        for term in ['ÄRGER', 'ärger', 'ÄR', 'är', 'Ä', 'ÄRG%', 'ärg%', '@ÄRZ', '$im par']:
+            self.assertEqual(len(smj7.search_media(term)), 1, term)
+
+
+if __name__ == '__main__':
+    unittest.main()